@@ -1,7 +1,24 @@
 """Example program training/inference on digit recognition problem with tensorflow 2.0."""
 import argparse
-import cv2
 import os
+
+# parse arguments before importing tensorflow: CUDA_VISIBLE_DEVICES has to be
+# set before TF discovers devices and creates its GPU context
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='parameters for program')
+    parser.add_argument('procedure', choices=['train', 'inference', 'find_lr', 'quantize'],
+                        help='Whether to train a new model or use trained model to inference.')
+    parser.add_argument('--image_path', default=None, help='Path to jpeg image file to predict on.')
+    parser.add_argument('--gpu', default='', help='gpu device id expose to program, default is cpu only.')
+    parser.add_argument('--optimizer', default='Adam', help='optimizer of choice.')
+    parser.add_argument('--use_swa', default=False, action='store_true', help='wrap optimizer with SWA')
+    parser.add_argument('--use_lookahead', default=False, action='store_true', help='wrap optimizer with Lookahead')
+    parser.add_argument('--mc_dropout', default=False, action='store_true', help='whehter to evalutate MC dropout')
+    parser.add_argument('--verbose', type=int, default=0)
+    args = parser.parse_args()
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+
+import numpy as np
 import tensorflow as tf
 from datetime import datetime
 from tensorflow import keras
@@ -12,68 +29,263 @@ from optimizers.schedulers import LRFinder
 # Added option to try some other optimizers.
 # Added procedure to plot learning rate finder result.
 
+tf.config.optimizer.set_jit(True)  # XLA auto-clustering for ops outside the jit-compiled steps
 
-BATCH_SIZE = 32
+BATCH_SIZE = 512
 NUM_CLASS = 10
 NUM_EPOCHS = 30
-LEARNING_RATE = 1e-3
+MC_SAMPLES = 100
+LEARNING_RATE = 1.6e-2  # 1e-3 at batch 32, scaled linearly for batch 512
 if not os.path.exists('models/mnist_mlp_function/'):
     os.mkdir('models/mnist_mlp_function/')
 MODEL_FILE = 'models/mnist_mlp_function/model'
+TFLITE_MODEL_FILE = 'models/mnist_mlp_function/model_int8.tflite'
+MNIST_CACHE_DIR = 'data/mnist_f32/'
+
+
+def _load_mnist_cached():
+    """Load MNIST as flattened float32 arrays, converting once and memmapping thereafter."""
+    if not os.path.exists(MNIST_CACHE_DIR):
+        os.mkdir(MNIST_CACHE_DIR)
+    sizes = {'train': 60000, 'valid': 10000}
+    paths = {split: (os.path.join(MNIST_CACHE_DIR, 'x_{}.f32'.format(split)),
+                     os.path.join(MNIST_CACHE_DIR, 'y_{}.npy'.format(split))) for split in sizes}
+    if not all(os.path.exists(path) for pair in paths.values() for path in pair):
+        (x_train, y_train), (x_valid, y_valid) = keras.datasets.mnist.load_data()
+        for split, x, y in (('train', x_train, y_train), ('valid', x_valid, y_valid)):
+            x_path, y_path = paths[split]
+            out = np.memmap(x_path, dtype=np.float32, mode='w+', shape=(sizes[split], 784))
+            # single vectorized cast+scale pass, written straight into the mapped file
+            out[:] = x.reshape(sizes[split], 784).astype(np.float32, copy=False) * np.float32(1 / 255)
+            out.flush()
+            np.save(y_path, y)
+    arrays = []
+    for split in ('train', 'valid'):
+        x_path, y_path = paths[split]
+        arrays.append(np.memmap(x_path, dtype=np.float32, mode='r', shape=(sizes[split], 784)))
+        arrays.append(np.load(y_path))
+    return tuple(arrays)
+
+
+def _make_accumulators():
+    """Running loss sum / correct count / sample count, updatable inside a tf.function."""
+    return (tf.Variable(0., trainable=False),
+            tf.Variable(0, trainable=False, dtype=tf.int64),
+            tf.Variable(0, trainable=False, dtype=tf.int64))
+
+
+def _accumulate(stats, loss, y_batch, out):
+    loss_sum, correct, count = stats
+    batch = tf.cast(tf.shape(y_batch)[0], tf.int64)
+    loss_sum.assign_add(loss * tf.cast(batch, tf.float32))
+    correct.assign_add(tf.reduce_sum(tf.cast(
+        tf.equal(tf.argmax(out, -1, output_type=tf.int64), tf.cast(y_batch, tf.int64)), tf.int64)))
+    count.assign_add(batch)
+
+
+def _reset(stats):
+    loss_sum, correct, count = stats
+    loss_sum.assign(0.)
+    correct.assign(0)
+    count.assign(0)
+
+
+def _result(stats):
+    """Sync to host once and return (mean loss, accuracy)."""
+    loss_sum, correct, count = stats
+    count_f = float(count.numpy())
+    return float(loss_sum.numpy()) / count_f, float(correct.numpy()) / count_f
+
+
+def _pipeline_options():
+    """tf.data graph-level optimizations that are not all enabled by default.
+
+    Needs tensorflow >= 2.7, where the threading options left experimental.
+    """
+    options = tf.data.Options()
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_optimization.parallel_batch = True
+    options.experimental_deterministic = False
+    options.threading.private_threadpool_size = os.cpu_count()
+    return options
 
 
 class MLP(keras.Model):
-    """MLP model class using tf.Keras API."""
+    """MLP model class using tf.Keras API.
+
+    Built with the Functional API so every Dense/BN/Activation is a first-class
+    graph node visible to XLA auto-clustering, instead of being hidden inside
+    nested Sequential containers.
+    """
     def __init__(self, num_class=NUM_CLASS):
         super(MLP, self).__init__()
-        self.encoder = keras.Sequential([
-            keras.layers.Dense(units=128),
-            keras.layers.BatchNormalization(),
-            keras.layers.Activation(activation='relu'),
-            keras.layers.Dense(units=32),
-            keras.layers.BatchNormalization(),
-            keras.layers.Activation(activation='relu')
-        ])
-        self.decoder = keras.Sequential([
-            keras.layers.Dense(units=num_class),
-            keras.layers.Dropout(rate=.1),
-            keras.layers.Activation(activation='softmax')
-        ])
+        inputs = keras.Input(shape=(784,))
+        # bias before batch norm is cancelled by the mean subtraction, so skip it
+        h = keras.layers.Dense(units=128, use_bias=False)(inputs)
+        h = keras.layers.BatchNormalization()(h)
+        h = keras.layers.Activation(activation='relu')(h)
+        h = keras.layers.Dense(units=32, use_bias=False)(h)
+        h = keras.layers.BatchNormalization()(h)
+        h = keras.layers.Activation(activation='relu')(h)
+        h = keras.layers.Dense(units=num_class)(h)
+        h = keras.layers.Dropout(rate=.1)(h)
+        # keep the output fp32 even under a mixed_float16 policy
+        out = keras.layers.Activation(activation='softmax', dtype='float32')(h)
+        self._model = keras.Model(inputs, out)
 
     def call(self, x, training=True):
-        x = self.encoder(x, training=training)
-        x = self.decoder(x, training=training)
-        return x
+        return self._model(x, training=training)
 
 
-def find_lr(optimizer='Adam', verbose=0):
-    fname = 'plots/mnist_lr_finder_for_{}.png'.format(optimizer)
+def fold_batch_norm(model):
+    """Fold each BatchNormalization into the preceding Dense for inference.
+
+    With frozen statistics, Dense -> BN equals a single Dense with
+    kernel' = kernel * gamma / sqrt(var + eps) and
+    bias' = (bias - mean) * gamma / sqrt(var + eps) + beta,
+    so the returned model skips the batch norm kernels entirely.
+    """
+    layers, weights = [], []
+    for layer in model._model.layers:
+        if isinstance(layer, keras.layers.InputLayer):
+            continue
+        if isinstance(layer, keras.layers.Dense):
+            # pin fp32 so the folded model is unaffected by a mixed_float16 policy
+            layers.append(keras.layers.Dense(units=layer.units, dtype='float32'))
+            bias = layer.bias.numpy() if layer.use_bias else np.zeros(layer.units, dtype=np.float32)
+            weights.append([layer.kernel.numpy(), bias])
+        elif isinstance(layer, keras.layers.BatchNormalization):
+            gamma, beta, mean, var = [v.numpy() for v in layer.weights]
+            scale = gamma / np.sqrt(var + layer.epsilon)
+            kernel, bias = weights[-1]
+            weights[-1] = [kernel * scale, (bias - mean) * scale + beta]
+        elif isinstance(layer, keras.layers.Dropout):
+            continue  # inactive at inference
+        else:
+            layers.append(keras.layers.Activation(layer.activation, dtype='float32'))
+    folded = keras.Sequential(layers)
+    folded.build(input_shape=(None, 784))
+    dense_layers = [layer for layer in folded.layers if isinstance(layer, keras.layers.Dense)]
+    for dense, w in zip(dense_layers, weights):
+        dense.set_weights(w)
+    return folded
+
+
+_BUILD_CACHE = {}
+
+
+def _build(optimizer_name, use_swa=False, use_lookahead=False):
+    """Construct model, optimizer and compiled step functions, cached by configuration.
+
+    Repeat calls with the same configuration reuse the already-traced concrete
+    functions instead of paying model construction and autograph again, but the
+    model weights and the optimizer state are restored to their initial values
+    on every cache hit so each call still starts training from scratch.
+    """
+    # the policy shapes both the model (fp16 compute dtypes) and the optimizer
+    # (loss scale wrapper), so entries built under different policies must not mix
+    key = (optimizer_name, use_swa, use_lookahead, keras.mixed_precision.global_policy().name)
+    if key in _BUILD_CACHE:
+        built, init_weights, opt_init = _BUILD_CACHE[key]
+        model, optimizer = built[0], built[1]
+        model.set_weights(init_weights)
+        for var, value in zip(optimizer.variables(), opt_init):
+            var.assign(value)
+        optimizer.lr = LEARNING_RATE  # find_lr sweeps the lr, restore the default
+        return built
+
     model = MLP()
+    model.build(input_shape=(None, 784))  # pre-materialize variables before tracing
     criterion = keras.losses.SparseCategoricalCrossentropy()
-    if optimizer == 'Adam':
+    if optimizer_name == 'Adam':
         optimizer = keras.optimizers.Adam(learning_rate=LEARNING_RATE)
     else:
-        optimizer = get_optimizer(optimizer, learning_rate=LEARNING_RATE)
-    mnist = keras.datasets.mnist
-    (x_train, y_train), (x_valid, y_valid) = mnist.load_data()
-    x_train = x_train.reshape(60000, 784).astype('float32') / 255.0
-    train_dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train)).batch(BATCH_SIZE)
+        optimizer = get_optimizer(optimizer_name, learning_rate=LEARNING_RATE)
+    if use_swa:
+        optimizer = SWA(optimizer, swa_start=25, swa_freq=1)
+    if use_lookahead:
+        optimizer = Lookahead(optimizer)
+    scaler = None
+    if keras.mixed_precision.global_policy().name == 'mixed_float16':
+        # the loss scale wrapper must stay outermost: SWA/Lookahead drive updates
+        # through OptimizerV2 internals it does not implement, and wrapping it
+        # inside them would bypass the inf/nan update skip
+        optimizer = scaler = keras.mixed_precision.LossScaleOptimizer(optimizer)
+    # plain variable accumulators: one assign_add per batch inside the compiled
+    # step instead of a keras.metrics subgraph launch per metric per batch
+    train_stats = _make_accumulators()
+    test_stats = _make_accumulators()
 
-    @tf.function
+    # fixed input signatures so an odd-sized final batch can never retrace
+    step_signature = [tf.TensorSpec([None, 784], tf.float32), tf.TensorSpec([None], tf.uint8)]
+
+    @tf.function(input_signature=step_signature, jit_compile=True)
     def train_step(x_batch, y_batch):
         with tf.GradientTape() as tape:
             out = model(x_batch, training=True)
             loss = criterion(y_batch, out)
-        grad = tape.gradient(loss, model.trainable_variables)
+            scaled_loss = scaler.get_scaled_loss(loss) if scaler is not None else loss
+        grad = tape.gradient(scaled_loss, model.trainable_variables)
+        if scaler is not None:
+            grad = scaler.get_unscaled_gradients(grad)
         optimizer.apply_gradients(zip(grad, model.trainable_variables))
+        _accumulate(train_stats, loss, y_batch, out)
         return loss
 
+    @tf.function(input_signature=step_signature, jit_compile=True)
+    def valid_step(x_batch, y_batch):
+        out = model(x_batch, training=False)
+        loss = criterion(y_batch, out)
+        _accumulate(test_stats, loss, y_batch, out)
+
+    @tf.function(input_signature=step_signature, jit_compile=True)
+    def valid_step_with_dropout(x_batch, y_batch):
+        # online mean over dropout samples: accumulate out/MC_SAMPLES per pass
+        # so the (MC_SAMPLES, batch, class) stack is never materialized
+        inv = 1.0 / MC_SAMPLES
+
+        def body(i, acc):
+            return i + 1, acc + model(x_batch, training=True) * inv
+
+        _, out = tf.while_loop(
+            lambda i, _: i < MC_SAMPLES, body,
+            [0, tf.zeros((tf.shape(x_batch)[0], NUM_CLASS))],
+            parallel_iterations=MC_SAMPLES)
+        loss = criterion(y_batch, out)
+        _accumulate(test_stats, loss, y_batch, out)
+
+    built = (model, optimizer, criterion, train_step, valid_step,
+             valid_step_with_dropout, train_stats, test_stats)
+    init_weights = [w.copy() for w in model.get_weights()]
+    # one zero-gradient apply materializes the optimizer variables (slots,
+    # iteration counter, loss scale state) so their pristine values can be
+    # snapshotted here and restored on cache hits
+    optimizer.apply_gradients(
+        zip([tf.zeros_like(v) for v in model.trainable_variables], model.trainable_variables))
+    _BUILD_CACHE[key] = (built, init_weights, [v.numpy() for v in optimizer.variables()])
+    return built
+
+
+def find_lr(optimizer='Adam', verbose=0):
+    fname = 'plots/mnist_lr_finder_for_{}.png'.format(optimizer)
+    model, optimizer, criterion, train_step = _build(optimizer)[:4]
+    x_train, y_train, _, __ = _load_mnist_cached()
+    train_dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train)) \
+        .batch(BATCH_SIZE, drop_remainder=True).prefetch(tf.data.AUTOTUNE).with_options(_pipeline_options())
+    if tf.config.list_physical_devices('GPU'):
+        # stage the next batches in GPU memory; must stay the last transformation
+        train_dataset = train_dataset.apply(tf.data.experimental.prefetch_to_device('/gpu:0', buffer_size=2))
+
     lr_finder = LRFinder(start_lr=1e-7, max_lr=1e-1)
+
+    @tf.function
+    def lr_find_step(x_batch, y_batch):
+        # the loss stays on device: lr_finder.step records it and yields the next lr
+        optimizer.lr.assign(lr_finder.step(train_step(x_batch, y_batch)))
+
     for idx, (x_batch, y_batch) in enumerate(train_dataset):
-        loss = train_step(x_batch, y_batch)
-        new_lr = lr_finder.step(loss.numpy())
-        optimizer.lr.assign(new_lr)
-        if lr_finder.done:
+        lr_find_step(x_batch, y_batch)
+        if (idx + 1) % 8 == 0 and lr_finder.done:  # only sync with the host every 8 batches
             break
     lr_finder.plot_lr(fname)
     if verbose:
@@ -82,143 +294,170 @@ def find_lr(optimizer='Adam', verbose=0):
 
 def train(optimizer='Adam', use_swa=False, use_lookahead=False, mc_dropout=False, verbose=0):
     """Train the model."""
+    if tf.config.list_physical_devices('GPU'):
+        # fp16 matmuls on tensor cores; variables and the softmax output stay fp32
+        keras.mixed_precision.set_global_policy('mixed_float16')
+
     # load dataset
-    mnist = keras.datasets.mnist
-    (x_train, y_train), (x_valid, y_valid) = mnist.load_data()
-    x_train = x_train.reshape(60000, 784).astype('float32') / 255.0
-    x_valid = x_valid.reshape(10000, 784).astype('float32') / 255.0
-    train_dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train)).batch(BATCH_SIZE)
-    valid_dataset = tf.data.Dataset.from_tensor_slices((x_valid, y_valid)).batch(BATCH_SIZE)
+    x_train, y_train, x_valid, y_valid = _load_mnist_cached()
+    # keep the training set resident as tensors (on device when a GPU is present)
+    # and shuffle by gathering batches through a fresh permutation each epoch;
+    # this replaces the 60k-element tf.data shuffle buffer with a single gather
+    x_train_t = tf.constant(x_train)
+    y_train_t = tf.constant(y_train)
+    train_dataset = tf.data.Dataset.range(1) \
+        .map(lambda _: tf.random.shuffle(tf.range(60000))) \
+        .unbatch().batch(BATCH_SIZE, drop_remainder=True) \
+        .map(lambda idx: (tf.gather(x_train_t, idx), tf.gather(y_train_t, idx))) \
+        .prefetch(tf.data.AUTOTUNE).with_options(_pipeline_options())
+    valid_dataset = tf.data.Dataset.from_tensor_slices((x_valid, y_valid)) \
+        .cache().batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE).with_options(_pipeline_options())
+    if tf.config.list_physical_devices('GPU'):
+        # stage the next batches in GPU memory; must stay the last transformation
+        train_dataset = train_dataset.apply(tf.data.experimental.prefetch_to_device('/gpu:0', buffer_size=2))
 
     # config model
-    model = MLP()
-    criterion = keras.losses.SparseCategoricalCrossentropy()
-    if optimizer == 'Adam':
-        optimizer = keras.optimizers.Adam(learning_rate=LEARNING_RATE)
-    else:
-        optimizer = get_optimizer(optimizer, learning_rate=LEARNING_RATE)
-    if use_swa:
-        optimizer = SWA(optimizer, swa_start=25, swa_freq=1)
-    if use_lookahead:
-        optimizer = Lookahead(optimizer)
-    train_loss = keras.metrics.Mean()
-    train_accuracy = keras.metrics.SparseCategoricalAccuracy()
-    test_loss = keras.metrics.Mean()
-    test_accuracy = keras.metrics.SparseCategoricalAccuracy()
+    (model, optimizer, criterion, train_step, valid_step,
+     valid_step_with_dropout, train_stats, test_stats) = _build(optimizer, use_swa, use_lookahead)
 
-    @tf.function
-    def train_step(x_batch, y_batch):
-        with tf.GradientTape() as tape:
-            out = model(x_batch, training=True)
-            loss = criterion(y_batch, out)
-        grad = tape.gradient(loss, model.trainable_variables)
-        optimizer.apply_gradients(zip(grad, model.trainable_variables))
-        train_loss(loss)
-        train_accuracy(y_batch, out)
-
-    @tf.function
-    def valid_step(x_batch, y_batch):
-        out = model(x_batch, training=False)
-        loss = criterion(y_batch, out)
-        test_loss(loss)
-        test_accuracy(y_batch, out)
-
-    @tf.function
-    def valid_step_with_dropout(x_batch, y_batch, num_samples=100):
-        outs = []
-        for i in range(num_samples):
-            outs.append(model(x_batch, training=True))
-        out = tf.reduce_mean(tf.stack(outs), 0)
-        loss = criterion(y_batch, out)
-        test_loss(loss)
-        test_accuracy(y_batch, out)
+    # plain supervised path: let Keras drive its compiled training loop;
+    # the hand-rolled loop below is only kept for the SWA/Lookahead/MC dropout variants
+    if not (use_swa or use_lookahead or mc_dropout):
+        model.compile(optimizer=optimizer, loss=criterion,
+                      metrics=['sparse_categorical_accuracy'], jit_compile=True)
+        model.fit(train_dataset, validation_data=valid_dataset, epochs=NUM_EPOCHS, verbose=verbose)
+        model.save_weights(MODEL_FILE, save_format='tf')
+        return
 
     # training loop
     for epoch in range(NUM_EPOCHS):
         t0 = datetime.now()
         # train
-        train_loss.reset_states()
-        train_accuracy.reset_states()
+        _reset(train_stats)
         for idx, (x_batch, y_batch) in enumerate(train_dataset):
             train_step(x_batch, y_batch)
 
         # validate
-        test_loss.reset_states()
-        test_accuracy.reset_states()
+        _reset(test_stats)
         for idx, (x_batch, y_batch) in enumerate(valid_dataset):
             valid_step(x_batch, y_batch)
 
         message_template = 'epoch {:>3} time {} sec / epoch train cce {:.4f} acc {:4.2f}% test cce {:.4f} acc {:4.2f}%'
         t1 = datetime.now()
         if verbose:
+            train_cce, train_acc = _result(train_stats)
+            test_cce, test_acc = _result(test_stats)
             print(message_template.format(
                 epoch + 1, (t1 - t0).seconds,
-                train_loss.result(), train_accuracy.result() * 100,
-                test_loss.result(), test_accuracy.result() * 100
+                train_cce, train_acc * 100, test_cce, test_acc * 100
             ))
     if use_swa:
-        # for swa, use swa weights and reset batch_norm moving averages
-        optimizer.assign_swa_weights(model.variables)
+        # for swa, use swa weights and reset batch_norm moving averages;
+        # the loss scale wrapper only delegates hyperparameters, so reach
+        # through it for the SWA instance when mixed precision is active
+        swa = optimizer
+        if isinstance(swa, keras.mixed_precision.LossScaleOptimizer):
+            swa = swa.inner_optimizer
+        swa.assign_swa_weights(model.variables)
         # fix batch_norm moving averages
         for _, (x_batch, __) in enumerate(train_dataset):
             model(x_batch, training=True)
 
-        test_loss.reset_states()
-        test_accuracy.reset_states()
+        # evaluate with batch norm folded away, as the deployed model would run
+        folded = fold_batch_norm(model)
+        _reset(test_stats)
         for idx, (x_batch, y_batch) in enumerate(valid_dataset):
-            valid_step(x_batch, y_batch)
-        print('SWA model cce {:.4f} acc {:4.2f}% cce'.format(test_loss.result(), test_accuracy.result() * 100))
+            out = folded(x_batch, training=False)
+            _accumulate(test_stats, criterion(y_batch, out), y_batch, out)
+        test_cce, test_acc = _result(test_stats)
+        print('SWA model cce {:.4f} acc {:4.2f}% cce'.format(test_cce, test_acc * 100))
 
     if mc_dropout:
         # see how Monte Carlo Dropout performs
-        test_loss.reset_states()
-        test_accuracy.reset_states()
+        _reset(test_stats)
         for idx, (x_batch, y_batch) in enumerate(valid_dataset):
             valid_step(x_batch, y_batch)
+        test_cce, test_acc = _result(test_stats)
         message_template = 'test without mc dropout cce {:.4f} acc {:4.2f}%'
-        print(message_template.format(test_loss.result(), test_accuracy.result() * 100))
+        print(message_template.format(test_cce, test_acc * 100))
 
-        test_loss.reset_states()
-        test_accuracy.reset_states()
+        _reset(test_stats)
         for idx, (x_batch, y_batch) in enumerate(valid_dataset):
             valid_step_with_dropout(x_batch, y_batch)
+        test_cce, test_acc = _result(test_stats)
         message_template = 'test with mc dropout cce {:.4f} acc {:4.2f}%'
-        print(message_template.format(test_loss.result(), test_accuracy.result() * 100))
+        print(message_template.format(test_cce, test_acc * 100))
 
 
     # it appears that for keras.Model subclass model, we can only save weights in 2.0 alpha
     model.save_weights(MODEL_FILE, save_format='tf')
 
 
-def inference(filepath):
-    """Reconstruct the model, load weights and run inference on a given picture."""
+def quantize_and_save():
+    """Convert trained weights to a fully int8-quantized tflite model."""
     model = MLP()
     model.load_weights(MODEL_FILE)
-    image = cv2.imread(filepath, 0).reshape(1, 784).astype('float32') / 255
-    probs = model.predict(image)
-    print('it is a: {} with probability {:4.2f}%'.format(probs.argmax(), 100 * probs.max()))
+    model(tf.zeros((1, 784)), training=False)  # force variable creation so weights restore
+    model = fold_batch_norm(model)  # fold BN first so only Dense layers get quantized
 
+    x_train = _load_mnist_cached()[0]
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='parameters for program')
-    parser.add_argument('procedure', choices=['train', 'inference', 'find_lr'],
-                        help='Whether to train a new model or use trained model to inference.')
-    parser.add_argument('--image_path', default=None, help='Path to jpeg image file to predict on.')
-    parser.add_argument('--gpu', default='', help='gpu device id expose to program, default is cpu only.')
-    parser.add_argument('--optimizer', default='Adam', help='optimizer of choice.')
-    parser.add_argument('--use_swa', default=False, action='store_true', help='wrap optimizer with SWA')
-    parser.add_argument('--use_lookahead', default=False, action='store_true', help='wrap optimizer with Lookahead')
-    parser.add_argument('--mc_dropout', default=False, action='store_true', help='whehter to evalutate MC dropout')
-    parser.add_argument('--verbose', type=int, default=0)
-    args = parser.parse_args()
+    def representative_dataset():
+        for sample in x_train[:200]:
+            yield [sample.reshape(1, 784)]
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    with open(TFLITE_MODEL_FILE, 'wb') as f:
+        f.write(converter.convert())
 
+
+def inference(filepath):
+    """Run inference on a given picture, preferring the int8 tflite model when present."""
+    if os.path.exists(TFLITE_MODEL_FILE):
+        image = tf.reshape(
+            tf.io.decode_image(tf.io.read_file(filepath), channels=1, dtype=tf.float32), (1, 784)).numpy()
+        interpreter = tf.lite.Interpreter(model_path=TFLITE_MODEL_FILE)
+        interpreter.allocate_tensors()
+        input_detail = interpreter.get_input_details()[0]
+        output_detail = interpreter.get_output_details()[0]
+        scale, zero_point = input_detail['quantization']
+        interpreter.set_tensor(input_detail['index'], np.round(image / scale + zero_point).astype(np.int8))
+        interpreter.invoke()
+        out = interpreter.get_tensor(output_detail['index']).astype('float32')
+        out_scale, out_zero_point = output_detail['quantization']
+        probs = (out - out_zero_point) * out_scale
+    else:
+        model = MLP()
+        model.load_weights(MODEL_FILE)
+        model(tf.zeros((1, 784)), training=False)  # force variable creation so weights restore
+        model = fold_batch_norm(model)
+
+        # one traced function reading, decoding and classifying end to end;
+        # calling the model directly skips the dataset wrapper model.predict adds
+        @tf.function
+        def _predict(path):
+            img = tf.io.decode_image(tf.io.read_file(path), channels=1, dtype=tf.float32)
+            return model(tf.reshape(img, (1, 784)), training=False)
+
+        probs = _predict(tf.constant(filepath)).numpy()
+    print('it is a: {} with probability {:4.2f}%'.format(probs.argmax(), 100 * probs.max()))
+
+
+if __name__ == '__main__':
     if args.procedure == 'find_lr':
         find_lr(args.optimizer, args.verbose)
     elif args.procedure == 'train':
         train(args.optimizer, args.use_swa, args.use_lookahead, args.mc_dropout, args.verbose)
+    elif args.procedure == 'quantize':
+        assert os.path.exists(MODEL_FILE + '.index'), 'model not found, train a model before calling quantize.'
+        quantize_and_save()
     else:
-        assert os.path.exists(MODEL_FILE + '.index'), 'model not found, train a model before calling inference.'
+        assert os.path.exists(MODEL_FILE + '.index') or os.path.exists(TFLITE_MODEL_FILE), \
+            'model not found, train a model before calling inference.'
         assert os.path.exists(args.image_path), 'can not find image file.'
         inference(args.image_path)
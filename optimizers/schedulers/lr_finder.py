@@ -1,33 +1,58 @@
 import numpy as np
 import pandas as pd
+import tensorflow as tf
 from .scheduler import Scheduler
 from matplotlib import pyplot as plt
 
 
 class LRFinder(object):
     def __init__(self, start_lr=1e-7, max_lr=10., total_steps=100):
-        self._history = []
         self.scheduler = Scheduler(start_lr, max_lr, total_steps, 'exponential')
+        self.total_steps = total_steps
+        # the lr sweep does not depend on the observed losses, so precompute it
+        # once and keep the per-step bookkeeping in tensorflow variables
+        lrs = [self.scheduler.current_lr]
+        while not self.scheduler.done:
+            lrs.append(self.scheduler.step())
+        self._lrs = tf.constant(lrs, dtype=tf.float32)
+        self._losses = tf.Variable(tf.zeros(len(lrs)), trainable=False)
+        self._current_step = tf.Variable(0, trainable=False, dtype=tf.int32)
 
-    def step(self, val):
-        self._history.append({
-            'lr': self.scheduler.current_lr,
-            'loss': val,
-            'step': self.scheduler.current_step
-        })
-        return self.scheduler.step()
+    def step(self, loss):
+        """Record a scalar loss tensor and return the next learning rate as a tensor.
+
+        All bookkeeping is variable ops, so this can run inside a tf.function
+        without syncing the loss back to the host every step.
+        """
+        last = tf.size(self._lrs) - 1
+
+        def record():
+            self._losses.scatter_nd_update(
+                tf.reshape(self._current_step, (1, 1)), tf.reshape(tf.cast(loss, tf.float32), (1,)))
+            return self._current_step
+
+        # the caller only polls `done` periodically; steps past the end of the
+        # sweep must not keep overwriting the final history point
+        tf.cond(self._current_step <= last, record, lambda: self._current_step)
+        self._current_step.assign_add(1)
+        return tf.gather(self._lrs, tf.minimum(self._current_step, last))
 
     @property
     def done(self):
-        return self.scheduler.done
+        return int(self._current_step.numpy()) > self.total_steps
 
     @property
     def history(self):
-        return pd.DataFrame(self._history)
+        steps = min(int(self._current_step.numpy()), int(self._lrs.shape[0]))
+        return pd.DataFrame({
+            'lr': self._lrs.numpy()[:steps],
+            'loss': self._losses.numpy()[:steps],
+            'step': np.arange(steps)
+        })
 
     def plot_lr(self, fname):
         assert self.done, 'lr finder not done yet.'
-        df = pd.DataFrame(self._history)
+        df = self.history
         df['log_lr'] = np.log10(df['lr'])
         fig = df.plot(x='log_lr', y='loss')
         plt.savefig(fname)